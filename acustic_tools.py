@@ -12,36 +12,50 @@ import contextlib
 import wave
 import webrtcvad
 from itertools import chain
+from math import gcd
+import numpy as np
+from scipy.signal import resample_poly
 
 
 class FrameGenerator(object):
     class Frame(object):
-        """Represents a "frame" of audio data."""
-        def __init__(self, bytes, timestamp, duration):
+        """Represents a "frame" of audio data, and the same frame at the VAD sample rate."""
+        def __init__(self, bytes, timestamp, duration, vad_bytes=None):
             self.bytes = bytes
             self.timestamp = timestamp
             self.duration = duration
+            self.vad_bytes = bytes if vad_bytes is None else vad_bytes
 
             
-    def __init__(self, frame_duration_ms, audio, sample_rate):
+    def __init__(self, frame_duration_ms, audio, sample_rate, vad_audio=None, vad_sample_rate=None):
         self.frame_duration_ms = frame_duration_ms
         self.audio = audio
         self.sample_rate = sample_rate
+        self.vad_audio = audio if vad_audio is None else vad_audio
+        self.vad_sample_rate = sample_rate if vad_sample_rate is None else vad_sample_rate
         
     def __iter__(self):
-        n = int(self.sample_rate * (self.frame_duration_ms / 1000.0) * 2)
+        # Frames of whole 16 bits samples, so the bytes stay aligned at any sample rate
+        n = int(self.sample_rate * self.frame_duration_ms // 1000) * 2
+        vad_n = int(self.vad_sample_rate * self.frame_duration_ms // 1000) * 2
         offset = 0
         timestamp = 0.0
         duration = (float(n) / self.sample_rate) / 2.0
         while offset + n < len(self.audio):
-            yield self.Frame(self.audio[offset:offset + n], timestamp, duration)
+            # The VAD frame starts at the same time as the audio frame
+            vad_offset = int(round(offset / 2 * self.vad_sample_rate / self.sample_rate)) * 2
+            if vad_offset + vad_n > len(self.vad_audio):
+                break
+            yield self.Frame(self.audio[offset:offset + n], timestamp, duration, self.vad_audio[vad_offset:vad_offset + vad_n])
             timestamp += duration
             offset += n
 
 class SilenceRemover:
-    def __init__(self, sample_rate=32000, frame_duration_ms=30, padding_duration_ms=300, aggressiveness=2, audio_format='wav', verbose=1):  
-        assert sample_rate in (8000, 16000, 32000, 48000)
+    def __init__(self, sample_rate=24000, vad_sample_rate=16000, frame_duration_ms=30, padding_duration_ms=300, aggressiveness=2, audio_format='wav', verbose=1):  
+        # The speech decisions are computed on a copy resampled to vad_sample_rate
+        assert vad_sample_rate in (8000, 16000, 32000, 48000)
         self.sample_rate = sample_rate
+        self.vad_sample_rate = vad_sample_rate
         self.frame_duration_ms = frame_duration_ms
         self.padding_duration_ms = padding_duration_ms
         self.vad = webrtcvad.Vad(aggressiveness)
@@ -64,22 +78,33 @@ class SilenceRemover:
             sample_width = wf.getsampwidth()
             assert sample_width == 2
             sample_rate = wf.getframerate()
-            assert sample_rate in (8000, 16000, 32000, 48000)
             pcm_data = wf.readframes(wf.getnframes())
             return pcm_data, sample_rate
 
 
-    def write_wave(self, audio_data, filepath):
+    def write_wave(self, audio_data, filepath, sample_rate=None):
         """Writes a .wav file.
-        Takes PCM audio data and sample rate.
+        Takes PCM audio data and sample rate (self.sample_rate if not given).
         """
         with contextlib.closing(wave.open(filepath, 'wb')) as wf:
             wf.setnchannels(1)
             wf.setsampwidth(2)
-            wf.setframerate(self.sample_rate)
+            wf.setframerate(self.sample_rate if sample_rate is None else sample_rate)
             wf.writeframes(audio_data)
 
 
+    def resample_vad(self, audio_data, sample_rate):
+        """Resamples PCM audio data to the VAD sample rate.
+        Returns PCM audio data.
+        """
+        if sample_rate == self.vad_sample_rate:
+            return audio_data
+        factor = gcd(sample_rate, self.vad_sample_rate)
+        samples = np.frombuffer(audio_data, dtype='<i2').astype(np.float32)
+        samples = resample_poly(samples, self.vad_sample_rate // factor, sample_rate // factor)
+        return np.clip(samples, -32768, 32767).astype('<i2').tobytes()
+
+
     def vad_collector(self, frames):
         '''
         Filters out non-voiced audio frames. Given a webrtcvad.Vad and a source of audio frames, yields only the voiced audio. Uses a padded, sliding window algorithm over the audio frames.
@@ -105,7 +130,7 @@ class SilenceRemover:
 
         voiced_frames = []
         for frame in frames:
-            is_speech = self.vad.is_speech(frame.bytes, self.sample_rate)
+            is_speech = self.vad.is_speech(frame.vad_bytes, self.vad_sample_rate)
 
             # sys.stdout.write('1' if is_speech else '0')
             if not triggered:
@@ -152,7 +177,8 @@ class SilenceRemover:
         # create all directory structure
         pathlib.Path(output_filepath).parent.mkdir(parents=True, exist_ok=True)
         audio_data, sample_rate = self.read_wave(input_filepath)
-        frames = self.frame_generator(self.frame_duration_ms, audio_data, sample_rate)
+        vad_audio_data = self.resample_vad(audio_data, sample_rate)
+        frames = self.frame_generator(self.frame_duration_ms, audio_data, sample_rate, vad_audio_data, self.vad_sample_rate)
         frames = list(frames)
         segments = self.vad_collector(frames)
         flag = False
@@ -170,12 +196,12 @@ class SilenceRemover:
                 else:
                     if flag:
                         segment = segment + concat_segment
-                    self.write_wave(segment, output_filepath)
+                    self.write_wave(segment, output_filepath, sample_rate)
                     return True
         else:
             if self.verbose: print("----> Just Copying the file to:", output_filepath)
             # if fail to remove silence just write the file
-            self.write_wave(audio_data, output_filepath)
+            self.write_wave(audio_data, output_filepath, sample_rate)
 
 
     def process_folder(self, input_dir, output_dir, force=False):
@@ -196,7 +222,8 @@ if __name__ == "__main__":
     parser.add_argument('-o', '--output', default='output', help='Output folder.')
     parser.add_argument('--audio_format', type=str, default='wav',
                         help='Audio codec. Ex: wav, mp3, flac, etc.')
-    parser.add_argument('--sr', type=int, default=32000)    
+    parser.add_argument('--sr', type=int, default=24000)    
+    parser.add_argument('--vad_sr', type=int, default=16000, help='Sample rate used by the VAD: 8000, 16000, 32000 or 48000.')
     parser.add_argument('-a', '--aggressiveness', type=int, default=2,
                         help='set its aggressiveness mode, which is an integer between 0 and 3. 0 is the least aggressive about filtering out non-speech, 3 is the most aggressive.')
     parser.add_argument('-f', '--force', type=bool, default=False,
@@ -206,6 +233,7 @@ if __name__ == "__main__":
 
     silence_remover = SilenceRemover(
         sample_rate=args.sr, 
+        vad_sample_rate=args.vad_sr,
         frame_duration_ms=30, 
         padding_duration_ms=300, 
         audio_format=args.audio_format,
@@ -3,8 +3,11 @@ class Config:
     input_audio_format = 'mp3'
     output_audio_format = 'wav'
 
+    # separation settings
+    separation_sample_rate = 44100 # spleeter models work at 44.1 kHz
+
     # conversion settings
-    sample_rate = 24000
+    sample_rate = 24000 # final sample rate, audio is resampled once to it
 
     # remove silence settings
     aggressiveness = 2
@@ -14,18 +17,28 @@ class Config:
     max_duration = 20
     max_gap_duration = 3
     segment_extension = 0.2
+    discard_short_segments = True # drop segments shorter than min_duration
     threshold_db = 28
+    adaptive_threshold = False # choose threshold_db per file from its energy histogram
     frame_length = 1024
     hop_length = 256    
+    virtual_segments = False # only write offset manifests, no segment wav files
 
     # VAD settings
     frame_duration_ms = 30
     padding_duration_ms = 300
     aggressiveness = 2
-    vad_sample_rate = 32000
+    vad_sample_rate = 16000 # speech decisions only, on a copy resampled on the fly
 
     # normalization settings
-    target_dbfs = -25
+    target_dbfs = -25 # False to use the level of the files
+    target_dbfs_percentile = None # without target_dbfs, use this percentile of the file levels instead of their mean
+    normalization_workers = 1 # processes used to calculate the file levels
+
+    # output settings
+    output_shards = False # append the segments to shards with an index.csv, instead of one file per segment
+    shard_format = 'tar' # tar or bin
+    shard_size_mb = 1024
 
     # Pipeline settings
     temp_dir = 'tmp'
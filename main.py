@@ -6,112 +6,144 @@ from os.path import join, exists, isdir
 from os import listdir, makedirs
 from tqdm import tqdm
 from config import Config
-from shutil import rmtree
+from shutil import rmtree, copyfile
+from contextlib import nullcontext
 
 from spleeter_tools import SpleeterAPI
 from conversion_tools import AudioConverter
 from acustic_tools import SilenceRemover
 from segment_tools import  AudioSegmenter
 from normalization_tools import AudioNormalizer
+from shard_tools import ShardWriter
 
 
 def execute_pileline(input_dir, output_dir):
+    # A single writer for all the songs, so the shards reach shard_size_mb
+    shard_writer = None
+    if Config.output_shards and not Config.virtual_segments:
+        shard_writer = ShardWriter(
+            output_dir=output_dir,
+            shard_format=Config.shard_format,
+            shard_size_mb=Config.shard_size_mb
+        )
 
-    for songs_folder in tqdm(listdir(input_dir)):
+    with shard_writer if shard_writer is not None else nullcontext():
+        for songs_folder in tqdm(listdir(input_dir)):
         
-        input_folder = join(input_dir, songs_folder)
-        output_folder = join(output_dir, songs_folder.replace(' ', '_'))
-        temp_folder = join(output_folder, Config.temp_dir)
+            input_folder = join(input_dir, songs_folder)
+            output_folder = join(output_dir, songs_folder.replace(' ', '_'))
+            temp_folder = join(output_folder, Config.temp_dir)
         
-        print("> Running pipeline for: {}...".format(input_folder))
-
-        if not isdir(input_folder):
-            continue
-
-        print("--> Extracting vocals... ")
-        vocals_temp_folder = join(temp_folder, 'vocals')
-        if not (exists(vocals_temp_folder)):
-            makedirs(vocals_temp_folder)
-        spleeter_api = SpleeterAPI(
-            audio_format=Config.input_audio_format,
-            sample_rate=Config.vad_sample_rate,
-            verbose=Config.verbose
-        )
-        spleeter_api.process_folder(
-            input_dir=input_folder,
-            output_dir=vocals_temp_folder
-        )
+            print("> Running pipeline for: {}...".format(input_folder))
 
-        print("--> Converting audio files to wav... ")
-        converted_temp_folder = join(temp_folder, 'converted')
-        if not (exists(converted_temp_folder)):
-            makedirs(converted_temp_folder)
-        converter = AudioConverter(
-            input_format=Config.input_audio_format, 
-            output_format=Config.output_audio_format,
-            target_sr=Config.vad_sample_rate,
-            verbose=Config.verbose
-        )
-        converter.process_folder(
-            input_dir=vocals_temp_folder, 
-            output_dir=converted_temp_folder           
-        )
+            if not isdir(input_folder):
+                continue
+
+            print("--> Extracting vocals... ")
+            vocals_temp_folder = join(temp_folder, 'vocals')
+            if not (exists(vocals_temp_folder)):
+                makedirs(vocals_temp_folder)
+            spleeter_api = SpleeterAPI(
+                audio_format=Config.input_audio_format,
+                sample_rate=Config.separation_sample_rate,
+                verbose=Config.verbose
+            )
+            spleeter_api.process_folder(
+                input_dir=input_folder,
+                output_dir=vocals_temp_folder
+            )
+
+            print("--> Converting audio files to wav... ")
+            converted_temp_folder = join(temp_folder, 'converted')
+            if not (exists(converted_temp_folder)):
+                makedirs(converted_temp_folder)
+            converter = AudioConverter(
+                input_format=Config.input_audio_format, 
+                output_format=Config.output_audio_format,
+                target_sr=Config.sample_rate,
+                verbose=Config.verbose
+            )
+            converter.process_folder(
+                input_dir=vocals_temp_folder, 
+                output_dir=converted_temp_folder           
+            )
         
-        print("--> Removing silence... ")
-        vad_temp_folder = join(temp_folder, 'vad')
-        if not (exists(vad_temp_folder)):
-            makedirs(vad_temp_folder)
-        silence_remover = SilenceRemover(
-            sample_rate=Config.vad_sample_rate,
-            frame_duration_ms=Config.frame_duration_ms,
-            padding_duration_ms=Config.padding_duration_ms,
-            aggressiveness=Config.aggressiveness,
-            audio_format=Config.output_audio_format,
-            verbose=Config.verbose
-        )
-        silence_remover.process_folder(
-            input_dir=converted_temp_folder, 
-            output_dir=vad_temp_folder           
-        ) 
-
-        print("--> Building segments... ")
-        segments_temp_folder = join(temp_folder, 'segments')
-        if not (exists(segments_temp_folder)):
-            makedirs(segments_temp_folder)     
-        segmenter = AudioSegmenter(
-            audio_format=Config.output_audio_format,
-            sample_rate=Config.vad_sample_rate,
-            min_duration=Config.min_duration,
-            max_duration=Config.max_duration,
-            max_gap_duration=Config.max_gap_duration,
-            threshold_db=Config.threshold_db,
-            segment_extension=Config.segment_extension,
-            frame_length=Config.frame_length,
-            hop_length=Config.hop_length,
-            verbose=Config.verbose
-        )
-        segmenter.build_segments(
-            input_dir=vad_temp_folder, 
-            output_dir=segments_temp_folder           
-        )
+            print("--> Removing silence... ")
+            vad_temp_folder = join(temp_folder, 'vad')
+            if not (exists(vad_temp_folder)):
+                makedirs(vad_temp_folder)
+            silence_remover = SilenceRemover(
+                sample_rate=Config.sample_rate,
+                vad_sample_rate=Config.vad_sample_rate,
+                frame_duration_ms=Config.frame_duration_ms,
+                padding_duration_ms=Config.padding_duration_ms,
+                aggressiveness=Config.aggressiveness,
+                audio_format=Config.output_audio_format,
+                verbose=Config.verbose
+            )
+            silence_remover.process_folder(
+                input_dir=converted_temp_folder, 
+                output_dir=vad_temp_folder           
+            ) 
 
-        print("--> Normalizing audio files... ")
-        normalizer = AudioNormalizer(
-            audio_format = Config.output_audio_format,
-            target_dbfs = Config.target_dbfs,
-            verbose = Config.verbose
-        )
-        normalizer.normalize_folder(
-            input_dir=segments_temp_folder, 
-            output_dir=output_folder           
-        )
+            print("--> Building segments... ")
+            segments_temp_folder = join(temp_folder, 'segments')
+            if not (exists(segments_temp_folder)):
+                makedirs(segments_temp_folder)     
+            segmenter = AudioSegmenter(
+                audio_format=Config.output_audio_format,
+                sample_rate=Config.sample_rate,
+                min_duration=Config.min_duration,
+                max_duration=Config.max_duration,
+                max_gap_duration=Config.max_gap_duration,
+                threshold_db=Config.threshold_db,
+                adaptive_threshold=Config.adaptive_threshold,
+                segment_extension=Config.segment_extension,
+                discard_short=Config.discard_short_segments,
+                frame_length=Config.frame_length,
+                hop_length=Config.hop_length,
+                virtual=Config.virtual_segments,
+                verbose=Config.verbose
+            )
+            segmenter.build_segments(
+                input_dir=vad_temp_folder, 
+                output_dir=segments_temp_folder           
+            )
+
+            print("--> Normalizing audio files... ")
+            normalizer = AudioNormalizer(
+                audio_format = Config.output_audio_format,
+                target_dbfs = Config.target_dbfs,
+                target_percentile = Config.target_dbfs_percentile,
+                workers = Config.normalization_workers,
+                output_writer = shard_writer,
+                verbose = Config.verbose
+            )
+            if Config.virtual_segments:
+                normalizer.normalize_manifest(
+                    input_manifest=join(segments_temp_folder, 'segments.csv'),
+                    output_manifest=join(output_folder, 'segments.csv')
+                )
+            else:
+                normalizer.normalize_folder(
+                    input_dir=segments_temp_folder, 
+                    output_dir=output_folder,
+                    # The shards are shared by all the songs
+                    segment_id_prefix=songs_folder.replace(' ', '_') + '/'
+                )
         
-        if isdir(segments_temp_folder)  and Config.delete_temp:
-            rmtree(moises_temp_folder)
+            # Keep the segments statistics, the temp folders are removed below
+            if exists(join(segments_temp_folder, 'segments_stats.csv')):
+                copyfile(join(segments_temp_folder, 'segments_stats.csv'), join(output_folder, 'segments_stats.csv'))
+
+            if isdir(segments_temp_folder)  and Config.delete_temp:
+                rmtree(moises_temp_folder)
 
-        rmtree(converted_temp_folder)
-        rmtree(vad_temp_folder)
-        rmtree(segments_temp_folder)
+            rmtree(converted_temp_folder)
+            # Virtual segments point into the VAD files
+            if not Config.virtual_segments:
+                rmtree(vad_temp_folder)
+            rmtree(segments_temp_folder)
 
 
 def main():
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+import argparse
+import struct
+from os import makedirs
+from os.path import exists, getsize, join, dirname, abspath
+from collections import OrderedDict
+import numpy as np
+from scipy.io.wavfile import write
+
+
+def read_manifest(manifest_filepath):
+    '''
+    Reads a segments manifest with lines "id|filename|start|end[|gain_db]".
+    Start and end are sample offsets into the source wav file, relative filenames
+    are resolved against the folder of the manifest.
+    '''
+    manifest_dir = dirname(abspath(manifest_filepath))
+    records = []
+    with open(manifest_filepath) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('|')
+            if len(fields) < 4:
+                continue
+            gain_db = float(fields[4]) if len(fields) > 4 else 0.0
+            records.append((fields[0], join(manifest_dir, fields[1]), int(fields[2]), int(fields[3]), gain_db))
+    return records
+
+
+def write_manifest(manifest_filepath, records):
+    '''
+    Writes (id, filename, start, end, gain_db) records to a segments manifest.
+    '''
+    with open(manifest_filepath, 'w') as f:
+        for segment_id, filename, start, end, gain_db in records:
+            f.write('%s|%s|%d|%d|%.4f\n' % (segment_id, filename, start, end, gain_db))
+
+
+def read_wav_header(filepath):
+    '''
+    Parses the RIFF chunks of a PCM wav file.
+    Returns sample rate, number of channels, sample width, data offset and data size (in bytes).
+    '''
+    with open(filepath, 'rb') as f:
+        riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+        assert riff == b'RIFF' and wave_id == b'WAVE'
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                _, num_channels, sample_rate, _, _, bits_per_sample = struct.unpack('<HHIIHH', f.read(16))
+                fmt = (sample_rate, num_channels, bits_per_sample // 8)
+                f.seek(chunk_size - 16 + (chunk_size & 1), 1)
+            elif chunk_id == b'data':
+                assert fmt is not None
+                data_offset = f.tell()
+                # Streamed wav files may carry a bogus data size
+                data_size = min(chunk_size, getsize(filepath) - data_offset)
+                return fmt + (data_offset, data_size)
+            else:
+                f.seek(chunk_size + (chunk_size & 1), 1)
+    raise ValueError('No data chunk found in {}'.format(filepath))
+
+
+class VirtualSegmentReader:
+    '''
+    Serves normalized segments of a manifest lazily, memory-mapping the source wav files
+    instead of reading materialized segment files.
+    '''
+    def __init__(self, manifest_filepath):
+        self.records = OrderedDict((record[0], record) for record in read_manifest(manifest_filepath))
+        self.sources = {}
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def __iter__(self):
+        return iter(self.records)
+
+
+    def __map_source(self, filepath):
+        if filepath not in self.sources:
+            sample_rate, num_channels, sample_width, data_offset, data_size = read_wav_header(filepath)
+            assert num_channels == 1
+            assert sample_width == 2
+            samples = np.memmap(filepath, dtype='<i2', mode='r', offset=data_offset, shape=(data_size // 2,))
+            self.sources[filepath] = (samples, sample_rate)
+        return self.sources[filepath]
+
+
+    def read_raw(self, segment_id):
+        '''
+        Returns a view of the segment samples (int16) without gain, and its sample rate.
+        '''
+        _, filepath, start, end, _ = self.records[segment_id]
+        samples, sample_rate = self.__map_source(filepath)
+        return samples[start:end], sample_rate
+
+
+    def read(self, segment_id):
+        '''
+        Returns the normalized segment samples (int16) and its sample rate.
+        '''
+        gain_db = self.records[segment_id][4]
+        samples, sample_rate = self.read_raw(segment_id)
+        segment = samples.astype(np.float32) * (10 ** (gain_db / 20.0))
+        return np.clip(segment, -32768, 32767).astype(np.int16), sample_rate
+
+
+def main():
+    parser = argparse.ArgumentParser("Materializes the virtual segments of a manifest as wav files")
+    parser.add_argument('-m', '--manifest', required=True, help='Segments manifest.')
+    parser.add_argument('-o', '--output', required=True, help='Output folder.')
+    args = parser.parse_args()
+
+    if not exists(args.output):
+        makedirs(args.output)
+
+    reader = VirtualSegmentReader(args.manifest)
+    for segment_id in reader:
+        samples, sample_rate = reader.read(segment_id)
+        write(join(args.output, '%s.wav' % segment_id), sample_rate, samples)
+
+
+if __name__ == "__main__":
+    main()
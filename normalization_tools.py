@@ -2,59 +2,202 @@
 # -*- coding: utf-8 -*-
 #
 import argparse
-from os.path import exists, join, basename
+from os.path import exists, join, basename, isdir, abspath, dirname, relpath
+from collections import OrderedDict
 from os import makedirs
+from multiprocessing import Pool
 from tqdm import tqdm
 import numpy as np
 from pydub import AudioSegment
 from glob import glob
+from manifest_tools import VirtualSegmentReader, write_manifest
+from shard_tools import ShardWriter
+
+
+def calculate_dbfs(samples):
+    '''
+    dBFS of int16 samples, as computed by pydub's AudioSegment.dBFS
+    '''
+    rms = np.sqrt(np.mean(np.square(samples, dtype=np.float64))) if len(samples) else 0.0
+    if not rms:
+        return -float("infinity")
+    return 20 * np.log10(rms / 32768.0)
+
+
+class DbfsStatistics:
+    '''
+    Running level statistics of a set of files: the sample-weighted mean power, and a fixed-size
+    histogram of the file levels (weighted by their number of samples) for percentiles.
+    Statistics computed by different processes can be merged.
+    '''
+    def __init__(self, min_dbfs=-100.0, max_dbfs=0.0, bin_size=0.5):
+        self.bins = np.linspace(min_dbfs, max_dbfs, int(round((max_dbfs - min_dbfs) / bin_size)) + 1)
+        self.histogram = np.zeros(len(self.bins) - 1)
+        self.power_sum = 0.0 # sum of squared samples, relative to full scale
+        self.num_samples = 0
+
+
+    def update(self, samples, max_amplitude=32768.0):
+        '''
+        Adds the samples of a file
+        '''
+        samples = np.asarray(samples, dtype=np.float64) / max_amplitude
+        if not len(samples):
+            return self
+        power_sum = np.dot(samples, samples)
+        self.power_sum += power_sum
+        self.num_samples += len(samples)
+        if power_sum:
+            dbfs = 10 * np.log10(power_sum / len(samples))
+            index = np.clip(np.searchsorted(self.bins, dbfs, side='right') - 1, 0, len(self.histogram) - 1)
+            self.histogram[index] += len(samples)
+        return self
+
+
+    def merge(self, other):
+        assert np.array_equal(self.bins, other.bins)
+        self.histogram += other.histogram
+        self.power_sum += other.power_sum
+        self.num_samples += other.num_samples
+        return self
+
+
+    def mean_dbfs(self):
+        if not self.power_sum:
+            return -float("infinity")
+        return 10 * np.log10(self.power_sum / self.num_samples)
+
+
+    def percentile(self, q):
+        '''
+        Level (center of the histogram bin) below which q percent of the samples are
+        '''
+        # Only the bins holding samples, so low percentiles do not land on empty bins
+        nonzero = np.flatnonzero(self.histogram)
+        if not len(nonzero):
+            return -float("infinity")
+        cumulative = np.cumsum(self.histogram[nonzero])
+        index = nonzero[min(np.searchsorted(cumulative, q / 100.0 * cumulative[-1], side='left'), len(nonzero) - 1)]
+        return (self.bins[index] + self.bins[index + 1]) / 2
+
+
+def calculate_file_statistics(input_filepath):
+    '''
+    Level statistics of a single file, runs in the worker processes
+    '''
+    audio = AudioSegment.from_file(input_filepath)
+    return DbfsStatistics().update(audio.get_array_of_samples(), audio.max_possible_amplitude)
 
 
 class AudioNormalizer:
-    def __init__(self, target_dbfs=False, audio_format= 'wav', verbose=0):
+    def __init__(self, target_dbfs=False, audio_format= 'wav', target_percentile=None, workers=1, output_writer=None, verbose=0):
         self.audio_format = audio_format
         self.target_dbfs = target_dbfs
+        # Use a percentile of the file levels as target instead of the mean level
+        self.target_percentile = target_percentile
+        self.workers = workers
+        # Optional ShardWriter, appends the normalized segments to shards instead of exporting files
+        self.output_writer = output_writer
         self.verbose = verbose
+        self.statistics = DbfsStatistics()
+
+
+    def __calculate_target_dbfs(self, input_dir):
+        self.statistics = DbfsStatistics()
+        input_filepaths = glob(input_dir + '/*.{}'.format(self.audio_format))
+        if self.workers > 1:
+            with Pool(self.workers) as pool:
+                for statistics in tqdm(pool.imap_unordered(calculate_file_statistics, input_filepaths, chunksize=16), total=len(input_filepaths)):
+                    self.statistics.merge(statistics)
+        else:
+            for input_filepath in tqdm(input_filepaths):
+                self.statistics.merge(calculate_file_statistics(input_filepath))
+        return self.__statistics_target()
 
-    def __calculate_mean_dbfs(self, input_dir):
-        dbfs_list = []
-        for input_filepath in tqdm(glob(input_dir + '/*.{}'.format(self.audio_format))):
-            dbfs_list.append(AudioSegment.from_file(input_filepath).dBFS)
 
-        target_dbfs = np.array(dbfs_list).mean()
-        return target_dbfs
+    def __statistics_target(self):
+        if self.target_percentile is not None:
+            return self.statistics.percentile(self.target_percentile)
+        return self.statistics.mean_dbfs()
     
 
-    def normalize_folder(self, input_dir, output_dir):
-        if not self.target_dbfs:
+    def normalize_folder(self, input_dir, output_dir, segment_id_prefix=''):
+        # Without a configured target, every folder gets the target of its own files
+        target_dbfs = self.target_dbfs
+        if not target_dbfs:
             if self.verbose: print("----> Calculating average dBFS from files at: {}".format(input_dir))
-            self.target_dbfs = self.__calculate_mean_dbfs(input_dir)
+            target_dbfs = self.__calculate_target_dbfs(input_dir)
 
         for input_filepath in tqdm(glob(input_dir + '/*.{}'.format(self.audio_format))):
             if self.verbose: print("----> Normalizing file {}".format(basename(input_filepath)))
             filename = basename(input_filepath)
             output_filepath = join(output_dir, filename)
             audio = AudioSegment.from_file(input_filepath)
-            change_in_dBFS = self.target_dbfs - audio.dBFS
+            change_in_dBFS = target_dbfs - audio.dBFS
             normalized_sound = audio.apply_gain(change_in_dBFS)
-            normalized_sound.export(output_filepath, format=self.audio_format)
+            if self.output_writer is not None:
+                normalized_sound = normalized_sound.set_channels(1).set_sample_width(2)
+                segment_id = segment_id_prefix + filename.replace('.{}'.format(self.audio_format), '')
+                samples = np.array(normalized_sound.get_array_of_samples(), dtype=np.int16)
+                self.output_writer.write(segment_id, samples, normalized_sound.frame_rate)
+            else:
+                normalized_sound.export(output_filepath, format=self.audio_format)
+
+
+    def normalize_manifest(self, input_manifest, output_manifest):
+        '''
+        Computes the gain of every virtual segment of a manifest, reading the
+        segments from the memory-mapped source files instead of segment wav files.
+        '''
+        reader = VirtualSegmentReader(input_manifest)
+        self.statistics = DbfsStatistics()
+        dbfs = OrderedDict()
+        for segment_id in tqdm(reader):
+            samples, _ = reader.read_raw(segment_id)
+            dbfs[segment_id] = calculate_dbfs(samples)
+            if not self.target_dbfs:
+                self.statistics.update(samples)
+
+        target_dbfs = self.target_dbfs
+        if not target_dbfs:
+            if self.verbose: print("----> Calculating average dBFS from segments at: {}".format(input_manifest))
+            target_dbfs = self.__statistics_target()
+
+        # Sources relative to the output manifest, so the output tree can be moved as a whole
+        output_dir = dirname(abspath(output_manifest))
+        records = []
+        for segment_id, (_, filepath, start, end, _) in reader.records.items():
+            change_in_dBFS = target_dbfs - dbfs[segment_id] if np.isfinite(dbfs[segment_id]) else 0.0
+            records.append((segment_id, relpath(filepath, output_dir), start, end, change_in_dBFS))
+        write_manifest(output_manifest, records)
 
 
 def main():
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--input', required=True, help='Input folder.')
-    parser.add_argument('-o', '--output', required=True, help='Output folder.')
+    parser.add_argument('-i', '--input', required=True, help='Input folder or segments manifest.')
+    parser.add_argument('-o', '--output', required=True, help='Output folder or segments manifest.')
     parser.add_argument('--audio_format', default='wav', help="Audio format: wav, flac, mp3, etc.")
     parser.add_argument('--dbfs_target', default=False, help="Sugestion: -25.0")
+    parser.add_argument('--dbfs_percentile', type=float, default=None, help="Without dbfs_target, use this percentile of the file levels instead of the mean level.")
+    parser.add_argument('--workers', type=int, default=1, help="Processes used to calculate the file levels.")
+    parser.add_argument('--shard_format', default=False, help="Write packed shards instead of files: tar or bin.")
+    parser.add_argument('--shard_size_mb', type=float, default=1024, help="Shard size in MB.")
     parser.add_argument('--verbose', default=1, help="Verbosity level: 0 or 1.")
     args = parser.parse_args()
 
-    if not exists(args.output):
-        makedirs(args.output)
-
-    audio_normalizer = AudioNormalizer(args.dbfs_target, args.audio_format, args.verbose)
-    audio_normalizer.normalize_folder(args.input, args.output)
+    audio_normalizer = AudioNormalizer(args.dbfs_target, args.audio_format, args.dbfs_percentile, args.workers, verbose=args.verbose)
+    if isdir(args.input):
+        if not exists(args.output):
+            makedirs(args.output)
+        if args.shard_format:
+            with ShardWriter(args.output, args.shard_format, args.shard_size_mb) as writer:
+                audio_normalizer.output_writer = writer
+                audio_normalizer.normalize_folder(args.input, args.output)
+        else:
+            audio_normalizer.normalize_folder(args.input, args.output)
+    else:
+        audio_normalizer.normalize_manifest(args.input, args.output)
 
 
 if __name__ == "__main__":
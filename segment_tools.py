@@ -5,7 +5,7 @@
 from glob import glob
 import argparse
 from os import makedirs
-from os.path import isdir, dirname, join, basename
+from os.path import isdir, join, basename, abspath
 from collections import OrderedDict
 import librosa
 import numpy as np
@@ -16,14 +16,17 @@ from config import Config
 def audio_segmenter_runner(input_dir, output_dir):
     segmenter = AudioSegmenter(
         audio_format=Config.output_audio_format,
-        sample_rate=Config.vad_sample_rate,
+        sample_rate=Config.sample_rate,
         min_duration=Config.min_duration,
         max_duration=Config.max_duration,
         max_gap_duration=Config.max_gap_duration,
         threshold_db=Config.threshold_db,
+        adaptive_threshold=Config.adaptive_threshold,
         segment_extension=Config.segment_extension,
+        discard_short=Config.discard_short_segments,
         frame_length=Config.frame_length,
         hop_length=Config.hop_length,
+        virtual=Config.virtual_segments,
         verbose=Config.verbose
     )
     segmenter.build_segments(
@@ -56,32 +59,110 @@ class Segment:
         self.gap = next.gap
         self.end = next.end
 
+    def split_at(self, position):
+        # split current segment in two at position
+        next = Segment(position, self.end)
+        next.next = self.next
+        next.gap = self.gap
+        self.end = position
+        self.next = next
+        self.gap = 0
+
     def duration(self, sample_rate):
         return (self.end - self.start - 1) / sample_rate
 
 
 class AudioSegmenter:
-    def __init__(self, audio_format='wav', sample_rate=24000, min_duration=5, max_duration=15, max_gap_duration=0.5, threshold_db=28, segment_extension=0.2, frame_length=1024, hop_length=256, verbose=1):
+    def __init__(self, audio_format='wav', sample_rate=24000, min_duration=5, max_duration=15, max_gap_duration=0.5, threshold_db=28, adaptive_threshold=False, segment_extension=0.2, discard_short=True, frame_length=1024, hop_length=256, virtual=False, verbose=1):
         self.audio_format = audio_format
         self.sample_rate = sample_rate
         self.min_duration = min_duration
         self.max_duration = max_duration
         self.max_gap_duration = max_gap_duration
         self.threshold_db = threshold_db
+        # Choose threshold_db per file from the frame energy histogram
+        self.adaptive_threshold = adaptive_threshold
+        self.min_threshold_db = 10
+        self.histogram_bins = np.arange(0, 121) # 1 dB bins of depth below the loudest frame
         self.segment_extension = segment_extension
+        # Drop the segments shorter than min_duration that could not be merged
+        self.discard_short = discard_short
         self.frame_length = frame_length
         self.hop_length = hop_length
+        # Only write the segments.csv manifest, segments stay as offsets into the input wav files
+        self.virtual = virtual
         self.verbose = verbose
         self.output_filename = False
         self.output_filename_id = 1
 
 
+    def __frame_energy(self, wav):
+        '''
+        Compute frame energies (dB relative to the loudest frame) and their histogram
+        '''
+        rms = librosa.feature.rms(y=wav, frame_length=self.frame_length, hop_length=self.hop_length)[0]
+        frames_db = librosa.power_to_db(rms ** 2, ref=np.max, top_db=None)
+        histogram, _ = np.histogram(-frames_db, bins=self.histogram_bins)
+        return frames_db, histogram
+
+
+    def __nonsilent_regions(self, frames_db, threshold_db):
+        '''
+        Return the [start, end) frames of the regions louder than -threshold_db
+        '''
+        nonsilent = np.concatenate(([0], (frames_db > -threshold_db).astype(np.int8), [0]))
+        return np.flatnonzero(np.diff(nonsilent)).reshape(-1, 2)
+
+
+    def __threshold_cost(self, regions, num_frames):
+        '''
+        Seconds of audio that a split would lose or leave unsplittable: audio outside the
+        groups of regions that can be merged into at least min_duration, plus the audio
+        of regions beyond max_duration
+        '''
+        frame_duration = self.hop_length / self.sample_rate
+        if len(regions) == 0:
+            return num_frames * frame_duration
+        durations = (regions[:, 1] - regions[:, 0]) * frame_duration
+        too_long = np.maximum(durations - self.max_duration, 0).sum()
+        # Regions separated by gaps up to max_gap_duration end up merged
+        breaks = (regions[1:, 0] - regions[:-1, 1]) * frame_duration > self.max_gap_duration
+        first = np.flatnonzero(np.concatenate(([True], breaks)))
+        last = np.flatnonzero(np.concatenate((breaks, [True])))
+        spans = (regions[last, 1] - regions[first, 0]) * frame_duration
+        lost = num_frames * frame_duration - spans[spans >= self.min_duration].sum()
+        return lost + too_long
+
+
+    def __find_threshold(self, frames_db, histogram):
+        '''
+        Find the threshold that loses the least audio to silence, to groups shorter than
+        min_duration and to regions longer than max_duration, and then the fewest regions to merge
+        '''
+        # Thresholds deeper than the noise floor would not split anything
+        cumulative = np.cumsum(histogram) / max(histogram.sum(), 1)
+        noise_floor_db = int(self.histogram_bins[min(np.searchsorted(cumulative, 0.95) + 1, len(histogram))])
+        best, best_cost = None, None
+        for threshold_db in range(self.min_threshold_db, max(noise_floor_db, self.min_threshold_db) + 1):
+            regions = self.__nonsilent_regions(frames_db, threshold_db)
+            cost = (self.__threshold_cost(regions, len(frames_db)), len(regions))
+            if best_cost is None or cost < best_cost:
+                best, best_cost = (threshold_db, regions), cost
+        return best
+
+
     def __segment_wav(self, wav):
         '''
-        Segment audio file and return a segment linked list
+        Segment audio file and return a segment linked list, the threshold used and the number of regions
         '''
         # Find gaps at a fine resolution:
-        parts = librosa.effects.split(wav, top_db=self.threshold_db)
+        if self.adaptive_threshold:
+            frames_db, histogram = self.__frame_energy(wav)
+            threshold_db, regions = self.__find_threshold(frames_db, histogram)
+            parts = np.minimum(librosa.frames_to_samples(regions, hop_length=self.hop_length), len(wav))
+        else:
+            threshold_db = self.threshold_db
+            parts = librosa.effects.split(wav, top_db=self.threshold_db, frame_length=self.frame_length, hop_length=self.hop_length)
 
         # Build up a linked list of segments:
         head = None
@@ -92,7 +173,7 @@ class AudioSegmenter:
             else:
                 prev.set_next(segment)
             prev = segment
-        return head
+        return head, threshold_db, len(parts)
 
 
     def __find_best_merge(self, segments):
@@ -114,12 +195,37 @@ class AudioSegmenter:
         return best
 
 
+    def __find_split(self, energy, segment):
+        '''
+        Find the lowest-energy position of an overlong segment, such that the left part and the
+        remainder can both be split into segments between min_duration and max_duration
+        '''
+        # One more sample, as Segment.duration() does not count the last one
+        min_samples = int(np.ceil(self.min_duration * self.sample_rate)) + 1
+        max_samples = int(np.floor(self.max_duration * self.sample_rate)) + 1
+        length = segment.end - segment.start
+        # Fewest parts of at most max_duration
+        num_parts = -(-length // max_samples)
+        if num_parts * min_samples <= length:
+            first = segment.start + max(min_samples, length - (num_parts - 1) * max_samples)
+            last = segment.start + min(max_samples, length - (num_parts - 1) * min_samples)
+        else:
+            # Too short for num_parts segments of min_duration, keep all parts below max_duration
+            first = segment.start + length - (num_parts - 1) * max_samples
+            last = segment.start + max_samples
+        positions = np.arange(first, last + 1, self.hop_length)
+        # Energy of a frame_length window centered at each position, from the cumulative energy
+        half = self.frame_length // 2
+        window_energy = energy[np.minimum(positions + half, len(energy) - 1)] - energy[np.maximum(positions - half, 0)]
+        return positions[np.argmin(window_energy)]
+
+
     def __find_segments(self, filename, wav):
         '''
-        Given an audio file, creates the best possible segment list
+        Given an audio file, creates the best possible segment list and its statistics
         '''
         # Segment audio file
-        segments = self.__segment_wav(wav)
+        segments, threshold_db, num_regions = self.__segment_wav(wav)
         # Merge until we can't merge any more
         while True:
             best = self.__find_best_merge(segments)
@@ -127,22 +233,47 @@ class AudioSegmenter:
                 break
             best.merge_from(best.next)
 
+        # Split the segments longer than max_duration at their quietest point
+        energy = None
+        num_too_long, num_splits = 0, 0
+        s = segments
+        while s is not None:
+            num_too_long += s.duration(self.sample_rate) > self.max_duration
+            s = s.next
+        s = segments
+        while s is not None:
+            if s.duration(self.sample_rate) > self.max_duration:
+                if energy is None:
+                    energy = np.concatenate(([0.0], np.cumsum(np.square(wav, dtype=np.float64))))
+                s.split_at(self.__find_split(energy, s))
+                num_splits += 1
+                # Check the left part again before moving on
+                continue
+            s = s.next
+
         # Convert to list
         result = []
+        num_too_short = 0
         s = segments
         while s is not None:
-            result.append(s)
-            # Create a errors file
-            if (s.duration(self.sample_rate) < self.min_duration and
-                    s.duration(self.sample_rate) > self.max_duration):
-                    with open(join(dirname(__file__), "errors.txt"), "a") as f:
-                            f.write(filename+"\n")
+            if s.duration(self.sample_rate) < self.min_duration:
+                num_too_short += 1
+            if not self.discard_short or s.duration(self.sample_rate) >= self.min_duration:
+                result.append(s)
 
             # Extend the end by 0.2 sec as we sometimes lose the ends of words ending in unvoiced sounds.
-            s.end += int(self.segment_extension * self.sample_rate)
+            # The left parts of a split are followed by audio (no gap), and are not extended.
+            if s.next is None or s.gap > 0:
+                s.end = min(s.end + int(self.segment_extension * self.sample_rate),
+                            s.start + int(self.max_duration * self.sample_rate), len(wav))
             s = s.next
 
-        return result
+        stats = OrderedDict([
+            ('threshold_db', threshold_db), ('regions', num_regions), ('segments', len(result)),
+            ('too_long', num_too_long), ('splits', num_splits), ('too_short', num_too_short),
+            ('discarded', num_too_short if self.discard_short else 0)
+        ])
+        return result, stats
 
 
     def __load_filenames(self, input_dir):
@@ -166,6 +297,7 @@ class AudioSegmenter:
         # Initializes variables
         segment_max_duration, mean_duration = 0, 0
         all_segments = []
+        all_stats = OrderedDict()
         total_duration = 0
         filenames = self.__load_filenames(input_dir)
         if len(filenames) == 0:
@@ -176,11 +308,15 @@ class AudioSegmenter:
             if self.verbose: print('------> Loading %s: %s (%d of %d)' % (filename, input_filepath, i+1, len(filenames)))
 
             # Load audio
+            if self.virtual:
+                # Offsets must point to samples of the input file, so it can not be resampled
+                assert librosa.get_samplerate(input_filepath) == self.sample_rate
             audio_data, sample_rate = librosa.load(input_filepath, sr=self.sample_rate)
             if self.verbose > 1: print('------> Loaded %.1f min of audio. Splitting...' % (len(audio_data) / self.sample_rate / 60))
 
             # Find best segments
-            segments = self.__find_segments(input_filepath, audio_data)
+            segments, stats = self.__find_segments(input_filepath, audio_data)
+            all_stats[filename] = stats
             duration = sum((s.duration(self.sample_rate) for s in segments))
             total_duration += duration
 
@@ -188,34 +324,44 @@ class AudioSegmenter:
             j = int(self.output_filename_id)
             for s in segments:
                 all_segments.append(s)
-                s.set_filename_and_id(input_filepath, '%s-%04d' % (filename, j))
+                # Absolute paths keep the manifest usable from any working directory
+                s.set_filename_and_id(abspath(input_filepath), '%s-%04d' % (filename, j))
                 j = j + 1
 
             if self.verbose > 1: print('------> Segmented into %d parts (%.1f min, %.2f sec avg)' % (
-                len(segments), duration / 60, duration / len(segments)))
+                len(segments), duration / 60, duration / max(len(segments), 1)))
+            if self.verbose > 1: print('------> Split at %s dB into %d regions, %d too long (%d splits), %d too short (%d discarded)' % (
+                stats['threshold_db'], stats['regions'], stats['too_long'], stats['splits'], stats['too_short'], stats['discarded']))
 
             # Write segments to disk:
             for s in segments:
-                segment_wav = (audio_data[s.start:s.end] * 32767).astype(np.int16)
-                out_path = join(output_dir, '%s.wav' % s.id)
-                #librosa.output.write_wav(out_path, segment_wav, sample_rate)
-                write(out_path, self.sample_rate, segment_wav)
-
-                duration += len(segment_wav) / self.sample_rate
-                duration_segment = len(segment_wav) / self.sample_rate
+                if not self.virtual:
+                    segment_wav = (audio_data[s.start:s.end] * 32767).astype(np.int16)
+                    out_path = join(output_dir, '%s.wav' % s.id)
+                    #librosa.output.write_wav(out_path, segment_wav, sample_rate)
+                    write(out_path, self.sample_rate, segment_wav)
+
+                duration_segment = (s.end - s.start) / self.sample_rate
+                duration += duration_segment
                 if duration_segment > segment_max_duration:
                     segment_max_duration = duration_segment
 
                 mean_duration = mean_duration + duration_segment
-            if self.verbose > 1: print('------> Wrote %d segment wav files' % len(segments))
+            if self.verbose > 1 and not self.virtual: print('------> Wrote %d segment wav files' % len(segments))
             if self.verbose > 1: print('------> Progress: %d segments, %.2f hours, %.2f sec avg' % (
-                len(all_segments), total_duration / 3600, total_duration / len(all_segments)))
+                len(all_segments), total_duration / 3600, total_duration / max(len(all_segments), 1)))
 
         if self.verbose: print('------> Writing metadata for %d segments (%.2f hours)' % (len(all_segments), total_duration / 3600))
         with open(join(output_dir, 'segments.csv'), 'w') as f:
             for s in all_segments:
                 f.write('%s|%s|%d|%d\n' % (s.id, s.filename, s.start, s.end))
-        if self.verbose > 1: print('------> Mean: %f' %( mean_duration / len(segments) ))
+        with open(join(output_dir, 'segments_stats.csv'), 'w') as f:
+            f.write('filename|%s\n' % '|'.join(next(iter(all_stats.values())).keys()))
+            for filename, stats in all_stats.items():
+                f.write('%s|%s\n' % (filename, '|'.join(str(value) for value in stats.values())))
+        if self.verbose: print('------> Duration violations: %d too long (%d splits), %d too short (%d discarded)' % tuple(
+            sum(stats[key] for stats in all_stats.values()) for key in ('too_long', 'splits', 'too_short', 'discarded')))
+        if self.verbose > 1: print('------> Mean: %f' %( mean_duration / max(len(all_segments), 1) ))
         if self.verbose > 1: print('------> Max: %d' %(segment_max_duration ))
         return True
 
@@ -232,6 +378,9 @@ def main():
     parser.add_argument('--output_filename', type=str, default=False, help='')
     parser.add_argument('--output_filename_id', type=int, default=1, help='Sequencial number used for id filename.')
     parser.add_argument('--threshold_db', type=float, default=28.0, help='The threshold (in decibels) below reference to consider as silence')
+    parser.add_argument('--adaptive_threshold', action='store_true', help='Choose threshold_db per file from its energy histogram.')
+    parser.add_argument('--keep_short', action='store_true', help='Keep the segments shorter than min_duration.')
+    parser.add_argument('--virtual', action='store_true', help='Only write the segments.csv manifest, without segment wav files.')
     parser.add_argument('--verbose', default=1, help="Verbosity level: 0, 1 or 2.")
     args = parser.parse_args()
 
@@ -243,6 +392,9 @@ def main():
         max_duration=args.max_duration, 
         max_gap_duration=args.max_gap_duration, 
         threshold_db=args.threshold_db,
+        adaptive_threshold=args.adaptive_threshold,
+        discard_short=not args.keep_short,
+        virtual=args.virtual,
         verbose=args.verbose
     )
 
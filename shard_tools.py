@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+import argparse
+import io
+import tarfile
+import wave
+import contextlib
+from os import makedirs
+from os.path import exists, join, dirname
+from collections import OrderedDict
+import numpy as np
+from scipy.io.wavfile import write
+
+
+class ShardWriter:
+    '''
+    Appends segments to large tar or binary shard files, sequentially and buffered,
+    and writes an "index.csv" sidecar (id|shard|offset|size|sample_rate) for random access.
+    Offsets point to the raw PCM data (bin) or to the wav file data of the tar member (tar).
+    '''
+    def __init__(self, output_dir, shard_format='tar', shard_size_mb=1024, buffer_size_mb=8, prefix='shard'):
+        assert shard_format in ('tar', 'bin')
+        self.output_dir = output_dir
+        self.shard_format = shard_format
+        self.shard_size = int(shard_size_mb * 1024 * 1024)
+        self.buffer_size = int(buffer_size_mb * 1024 * 1024)
+        self.prefix = prefix
+        self.shard_id = -1
+        self.shard_filename = None
+        self.file = None
+        self.tar = None
+        self.index = []
+        self.segment_ids = set()
+        if not exists(output_dir):
+            makedirs(output_dir)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def __open_shard(self):
+        self.__close_shard()
+        self.shard_id += 1
+        self.shard_filename = '%s-%05d.%s' % (self.prefix, self.shard_id, self.shard_format)
+        self.file = open(join(self.output_dir, self.shard_filename), 'wb', buffering=self.buffer_size)
+        if self.shard_format == 'tar':
+            self.tar = tarfile.open(fileobj=self.file, mode='w')
+
+
+    def __close_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+    def write(self, segment_id, samples, sample_rate):
+        '''
+        Appends int16 mono samples of a segment to the current shard.
+        '''
+        if segment_id in self.segment_ids:
+            raise ValueError('Duplicate segment id {}'.format(segment_id))
+        self.segment_ids.add(segment_id)
+        data = np.asarray(samples, dtype='<i2').tobytes()
+        if self.file is None or self.file.tell() >= self.shard_size:
+            self.__open_shard()
+
+        if self.shard_format == 'tar':
+            buffer = io.BytesIO()
+            with contextlib.closing(wave.open(buffer, 'wb')) as wf:
+                wf.setnchannels(1)
+                wf.setsampwidth(2)
+                wf.setframerate(sample_rate)
+                wf.writeframes(data)
+            data = buffer.getvalue()
+            tarinfo = tarfile.TarInfo('%s.wav' % segment_id)
+            tarinfo.size = len(data)
+            self.tar.addfile(tarinfo, io.BytesIO(data))
+            # Member data is padded to a whole number of blocks at the end of the archive
+            offset = self.tar.offset - -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        else:
+            offset = self.file.tell()
+            self.file.write(data)
+        self.index.append((segment_id, self.shard_filename, offset, len(data), sample_rate))
+
+
+    def close(self):
+        self.__close_shard()
+        with open(join(self.output_dir, 'index.csv'), 'w') as f:
+            for segment_id, shard_filename, offset, size, sample_rate in self.index:
+                f.write('%s|%s|%d|%d|%d\n' % (segment_id, shard_filename, offset, size, sample_rate))
+
+
+class ShardReader:
+    '''
+    Random access reads of segments by id, using the "index.csv" sidecar of a shards folder.
+    '''
+    def __init__(self, shards_dir):
+        self.shards_dir = shards_dir
+        self.index = OrderedDict()
+        with open(join(shards_dir, 'index.csv')) as f:
+            for line in f:
+                segment_id, shard_filename, offset, size, sample_rate = line.rstrip('\n').split('|')
+                self.index[segment_id] = (shard_filename, int(offset), int(size), int(sample_rate))
+        self.files = {}
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def __iter__(self):
+        return iter(self.index)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def read(self, segment_id):
+        '''
+        Returns the int16 samples of a segment and its sample rate.
+        '''
+        shard_filename, offset, size, sample_rate = self.index[segment_id]
+        if shard_filename not in self.files:
+            self.files[shard_filename] = open(join(self.shards_dir, shard_filename), 'rb')
+        f = self.files[shard_filename]
+        f.seek(offset)
+        data = f.read(size)
+        if shard_filename.endswith('.tar'):
+            with contextlib.closing(wave.open(io.BytesIO(data), 'rb')) as wf:
+                data = wf.readframes(wf.getnframes())
+        return np.frombuffer(data, dtype='<i2'), sample_rate
+
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+def main():
+    parser = argparse.ArgumentParser("Extracts the segments of a shards folder as wav files")
+    parser.add_argument('-i', '--input', required=True, help='Shards folder.')
+    parser.add_argument('-o', '--output', required=True, help='Output folder.')
+    args = parser.parse_args()
+
+    if not exists(args.output):
+        makedirs(args.output)
+
+    with ShardReader(args.input) as reader:
+        for segment_id in reader:
+            samples, sample_rate = reader.read(segment_id)
+            output_filepath = join(args.output, '%s.wav' % segment_id)
+            # Ids of shared shards are prefixed by their song folder
+            if not exists(dirname(output_filepath)):
+                makedirs(dirname(output_filepath))
+            write(output_filepath, sample_rate, samples)
+
+
+if __name__ == "__main__":
+    main()